@@ -1,191 +1,411 @@
-import streamlit as st
-import google.generativeai as genai
-from PIL import Image, ImageDraw, ImageFont
-import io
-import json
-import re
-import datetime
-import os
-import pandas as pd
-
-# 1. SETUP PAGE
-st.set_page_config(page_title="Alh Jibrin Store AI", page_icon="🛒", layout="wide")
-
-# 2. SIDEBAR
-with st.sidebar:
-    st.image("https://cdn-icons-png.flaticon.com/512/2534/2534204.png", width=80)
-    st.title("Store Settings")
-    api_key = st.text_input("Google API Key", type="password")
-    
-    # LOAD DATABASE
-    try:
-        df = pd.read_csv("products.csv")
-        # Clean data for matching
-        df['Item Description'] = df['Item Description'].astype(str).str.lower().str.strip()
-        # Remove commas from price if they exist
-        if df['Sale Price'].dtype == 'O':
-            df['Sale Price'] = df['Sale Price'].astype(str).str.replace(',', '').astype(float)
-        
-        # Create Dictionary: {'sugar': 1500, 'milk': 500}
-        product_db = dict(zip(df['Item Description'], df['Sale Price']))
-        st.success(f"✅ Database Active: {len(product_db)} Items")
-        
-    except Exception as e:
-        st.error(f"⚠️ Could not load products.csv: {e}")
-        product_db = {}
-
-# 3. HELPER FUNCTIONS
-def get_model():
-    # Find best model
-    try:
-        models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        flash = [m for m in models if 'flash' in m.lower()]
-        return flash[0] if flash else models[0]
-    except:
-        return None
-
-def generate_receipt_image(scanned_list, grand_total):
-    # Draw Receipt
-    width, height = 500, 350 + (len(scanned_list) * 50)
-    img = Image.new("RGB", (width, height), "white")
-    draw = ImageDraw.Draw(img)
-    
-    # Fonts
-    try:
-        font_header = ImageFont.truetype("arial.ttf", 40)
-        font_body = ImageFont.truetype("arial.ttf", 24)
-        font_bold = ImageFont.truetype("arialbd.ttf", 24)
-    except:
-        font_header = ImageFont.load_default()
-        font_body = ImageFont.load_default()
-        font_bold = ImageFont.load_default()
-
-    # Header
-    draw.text((width//2, 30), "ALH JIBRIN STORE", fill="black", font=font_header, anchor="mm")
-    draw.text((width//2, 80), "Dukku, Gombe State", fill="black", font=font_body, anchor="mm")
-    draw.text((width//2, 120), datetime.datetime.now().strftime("%Y-%m-%d %H:%M"), fill="black", font=font_body, anchor="mm")
-    draw.line([(20, 150), (width-20, 150)], fill="black", width=2)
-    
-    # Columns
-    y = 170
-    draw.text((30, y), "QTY", font=font_bold, fill="black")
-    draw.text((100, y), "ITEM", font=font_bold, fill="black")
-    draw.text((380, y), "PRICE", font=font_bold, fill="black")
-    y += 40
-
-    # Items
-    for row in scanned_list:
-        item = row.get('item', 'Unknown')[:18]
-        qty = str(row.get('qty', 1))
-        total = row.get('line_total', 0)
-        draw.text((30, y), qty, font=font_body, fill="black")
-        draw.text((100, y), item, font=font_body, fill="black")
-        draw.text((380, y), f"N{total:,}", font=font_body, fill="black")
-        y += 40
-
-    # Footer
-    draw.line([(20, y+10), (width-20, y+10)], fill="black", width=2)
-    y += 30
-    draw.text((30, y), "TOTAL:", font=font_bold, fill="black")
-    draw.text((380, y), f"N{grand_total:,}", font=font_bold, fill="black")
-    y += 60
-    draw.text((width//2, y), "Thank you for your patronage!", font=font_body, fill="black", anchor="mm")
-    return img
-
-# 4. MAIN APP INTERFACE
-st.title("🧾 Smart Invoice")
-st.write("Upload a handwritten list to generate a receipt.")
-
-uploaded_file = st.file_uploader("Take a picture", type=["jpg", "jpeg", "png"])
-
-if uploaded_file and st.button("🚀 Process Invoice"):
-    if not api_key:
-        st.error("Please enter your Google API Key in the sidebar.")
-    else:
-        with st.spinner('Thinking...'):
-            try:
-                # Setup AI
-                os.environ["GOOGLE_API_KEY"] = api_key
-                genai.configure(api_key=api_key)
-                
-                image = Image.open(uploaded_file)
-                model_name = get_model()
-                model = genai.GenerativeModel(model_name)
-                
-                # AI Prompt
-                prompt = """
-                Analyze this handwritten shopping list.
-                1. Identify Quantity and Item Name.
-                2. Fix spelling errors (e.g. 'Semov' -> 'Semovita').
-                3. Return JSON ONLY: [{"qty": 1, "item": "Milk"}]
-                """
-                
-                response = model.generate_content([prompt, image])
-                
-                # Parse JSON
-                match = re.search(r'\[.*\]', response.text, re.DOTALL)
-                if match:
-                    raw_data = json.loads(match.group(0))
-                    
-                    final_total = 0
-                    clean_list = []
-                    
-                    # --- PRICE MATCHING ENGINE ---
-                    for row in raw_data:
-                        ai_name = row.get('item', '').lower().strip()
-                        qty = row.get('qty', 1)
-                        price = 0
-                        
-                        # 1. Try Exact Match
-                        if ai_name in product_db:
-                            price = product_db[ai_name]
-                        
-                        # 2. Try Fuzzy Match (if exact fails)
-                        if price == 0:
-                            for db_name, db_price in product_db.items():
-                                if ai_name in db_name or db_name in ai_name:
-                                    price = db_price
-                                    # Rename item to the correct DB name
-                                    row['item'] = db_name.title()
-                                    break
-                        
-                        line_total = qty * price
-                        final_total += line_total
-                        
-                        clean_list.append({
-                            "qty": qty, 
-                            "item": row.get('item').title(), 
-                            "line_total": line_total
-                        })
-                    
-                    # --- DISPLAY RESULTS ---
-                    st.success("Done!")
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        st.subheader("📝 List")
-                        st.table(clean_list)
-                        st.metric("Total To Pay", f"₦{final_total:,}")
-                        
-                    with col2:
-                        st.subheader("🖼️ Receipt")
-                        receipt_img = generate_receipt_image(clean_list, final_total)
-                        st.image(receipt_img, width=300)
-                        
-                        # Download Button
-                        buf = io.BytesIO()
-                        receipt_img.save(buf, format="JPEG")
-                        st.download_button(
-                            "📥 Download Receipt",
-                            data=buf.getvalue(),
-                            file_name="receipt.jpg",
-                            mime="image/jpeg"
-                        )
-                else:
-                    st.error("AI could not find a list in this image.")
-
-            except Exception as e:
-                if "429" in str(e):
-                    st.warning("🚦 Speed Limit Hit. Wait 30 seconds.")
-                else:
-                    st.error(f"Error: {e}")
\ No newline at end of file
+import streamlit as st
+import google.generativeai as genai
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+import io
+import html
+import json
+import re
+import csv
+import datetime
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz, process
+
+# 1. SETUP PAGE
+st.set_page_config(page_title="Alh Jibrin Store AI", page_icon="🛒", layout="wide")
+
+SALES_FILE = "sales.csv"
+
+# Words only: catalogue names use underscores and stray punctuation
+# ('20_leave', 'bisquit "240"') that plain str.split would keep attached
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+def _tokens(text):
+    return _WORD_RE.findall(text)
+
+def save_sale(items_summary, total):
+    # Append a single row; no need to reparse the whole history per sale
+    now = datetime.datetime.now()
+    new_file = not os.path.exists(SALES_FILE)
+    with open(SALES_FILE, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(["Date", "Time", "Items", "Total Amount"])
+        writer.writerow([now.strftime("%Y-%m-%d"), now.strftime("%H:%M"), items_summary, total])
+
+@st.cache_data(ttl=10, show_spinner=False)
+def load_sales_data():
+    if not os.path.exists(SALES_FILE):
+        return pd.DataFrame(columns=["Date", "Time", "Items", "Total Amount"])
+    return pd.read_csv(SALES_FILE)
+
+# 2. DATABASE LOADER (cached so pandas only reparses when the CSV changes)
+@st.cache_data(show_spinner=False)
+def load_product_db(path="products.csv", mtime=None):
+    # Clean names during the parse pass itself; blank filler rows in the
+    # CSV become '' and are dropped instead of turning into 'nan' keys
+    df = pd.read_csv(path, usecols=['Item Description', 'Sale Price'],
+                     converters={'Item Description': lambda s: s.strip().casefold()})
+    df = df[df['Item Description'] != '']
+    # Remove commas from price if they exist
+    prices = pd.to_numeric(
+        df['Sale Price'].astype(str).str.replace(',', '', regex=False),
+        errors='coerce',
+    ).fillna(0.0)
+    df['Sale Price'] = prices
+
+    # Create Dictionary: {'sugar': 1500, 'milk': 500}
+    product_db = dict(zip(df['Item Description'].to_numpy().tolist(), prices.to_numpy().tolist()))
+
+    # Inverted index: each word in a product name -> names containing it,
+    # so fuzzy matching only scores a handful of candidates instead of
+    # walking the whole dict per item
+    token_index = defaultdict(list)
+    for name in product_db:
+        for token in _tokens(name):
+            token_index[token].append(name)
+
+    # Keep only the two display columns so the cached frame stays small
+    return df[['Item Description', 'Sale Price']], product_db, dict(token_index), list(product_db)
+
+# 3. SIDEBAR
+with st.sidebar:
+    st.image("https://cdn-icons-png.flaticon.com/512/2534/2534204.png", width=80)
+    st.title("Store Settings")
+    api_key = st.text_input("Google API Key", type="password")
+
+    # LOAD DATABASE
+    try:
+        products_df, product_db, token_index, db_names = load_product_db(mtime=os.path.getmtime("products.csv"))
+        st.success(f"✅ Database Active: {len(product_db)} Items")
+        with st.expander("View Price List"):
+            # Expander contents render eagerly even when collapsed, so
+            # gate the Arrow serialization behind an explicit opt-in
+            if st.checkbox("Load price list"):
+                st.dataframe(products_df, use_container_width=True)
+
+    except Exception as e:
+        st.error(f"⚠️ Could not load products.csv: {e}")
+        products_df = pd.DataFrame(columns=['Item Description', 'Sale Price'])
+        product_db = {}
+        token_index = {}
+        db_names = []
+
+# 4. HELPER FUNCTIONS
+PROMPT = """
+Analyze this handwritten shopping list.
+1. Identify Quantity and Item Name.
+2. Fix spelling errors (e.g. 'Semov' -> 'Semovita').
+3. Return JSON ONLY: [{"qty": 1, "item": "Milk"}]
+"""
+
+def extract_json_array(text):
+    # Single pass over the response with a bracket-depth counter; unlike
+    # a greedy regex this can't backtrack and stops at the matching ']'
+    start = text.find('[')
+    if start < 0:
+        return None
+    depth = 0
+    for i in range(start, len(text)):
+        char = text[i]
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+@st.cache_data(show_spinner=False, hash_funcs={str: lambda k: hashlib.sha256(k.encode()).hexdigest()})
+def ocr_items(img_bytes, api_key):
+    # Keyed on the image bytes: re-processing the same photo (even after
+    # a re-upload) reuses the parsed list instead of paying Gemini again
+    image = Image.open(io.BytesIO(img_bytes))
+    # For JPEGs, let libjpeg downsample during DCT decode so the
+    # full-resolution buffer never materializes; Gemini caps useful
+    # detail around ~1k px anyway, so more is wasted upload bytes
+    image.draft("RGB", (1024, 1024))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((1024, 1024), Image.Resampling.BILINEAR)
+
+    model = get_model(api_key)
+    response = model.generate_content([PROMPT, image])
+
+    # JSON mode returns the array directly; fall back to scanning if
+    # the model wrapped it in prose
+    try:
+        return json.loads(response.text)
+    except ValueError:
+        json_text = extract_json_array(response.text)
+        if json_text is None:
+            # Raise rather than return None: st.cache_data would pin a
+            # None result for these image bytes, making the failure
+            # permanent; an uncached exception lets a re-click retry
+            raise ValueError("AI could not find a list in this image.")
+        return json.loads(json_text)
+
+
+def _pick_flash():
+    # Prefer a flash model; falls back to the first generateContent one
+    models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+    flash = [m for m in models if 'flash' in m.lower()]
+    return flash[0] if flash else models[0]
+
+@st.cache_resource(show_spinner=False, hash_funcs={str: lambda k: hashlib.sha256(k.encode()).hexdigest()})
+def get_model(api_key):
+    # Discover + construct once per session (list_models is a network
+    # call). Failures must propagate: Streamlit doesn't cache a call
+    # that raises, so a network blip or bad key is retried on the next
+    # click instead of pinning None in the cache, and the button
+    # handler already formats the error (including the 429 hint)
+    genai.configure(api_key=api_key)
+    model_name = _pick_flash()
+    # JSON mode: the model returns a bare array, no prose to scrape
+    return genai.GenerativeModel(model_name, generation_config={
+        "response_mime_type": "application/json",
+        "response_schema": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "qty": {"type": "integer"},
+                    "item": {"type": "string"},
+                },
+            },
+        },
+    })
+
+@st.cache_resource(show_spinner=False)
+def get_fonts():
+    # Parse the TTF files once per process instead of per receipt
+    try:
+        font_header = ImageFont.truetype("arial.ttf", 40)
+        font_body = ImageFont.truetype("arial.ttf", 24)
+        font_bold = ImageFont.truetype("arialbd.ttf", 24)
+    except OSError:
+        font_header = ImageFont.load_default()
+        font_body = ImageFont.load_default()
+        font_bold = ImageFont.load_default()
+    return font_header, font_body, font_bold
+
+@st.cache_resource(show_spinner=False)
+def get_receipt_template():
+    # Pre-render the static part of the receipt (store name, address,
+    # rule, column headers) once; only the date/items/total change
+    width = 500
+    img = Image.new("RGB", (width, 210), "white")
+    draw = ImageDraw.Draw(img)
+    font_header, font_body, font_bold = get_fonts()
+
+    draw.text((width//2, 30), "ALH JIBRIN STORE", fill="black", font=font_header, anchor="mm")
+    draw.text((width//2, 80), "Dukku, Gombe State", fill="black", font=font_body, anchor="mm")
+    draw.line([(20, 150), (width-20, 150)], fill="black", width=2)
+
+    draw.text((30, 170), "QTY", font=font_bold, fill="black")
+    draw.text((100, 170), "ITEM", font=font_bold, fill="black")
+    draw.text((380, 170), "PRICE", font=font_bold, fill="black")
+    return img
+
+def receipt_html(items_df, grand_total, timestamp):
+    # Lightweight HTML preview: the browser lays out the text itself, no
+    # PIL buffer/glyph/encode work just to show the receipt on screen
+    # Item names come from Gemini OCR (untrusted), so escape everything
+    # interpolated into the unsafe_allow_html markdown
+    rows = "".join(
+        f"<tr><td>{html.escape(str(qty))}</td><td>{html.escape(str(item))}</td>"
+        f"<td style='text-align:right'>N{total:,}</td></tr>"
+        for qty, item, total in zip(items_df['qty'], items_df['item'], items_df['line_total'])
+    )
+    return (
+        "<div style='background:#fff;color:#000;border:1px solid #ccc;"
+        "padding:16px;max-width:320px'>"
+        "<h3 style='text-align:center;margin:0'>ALH JIBRIN STORE</h3>"
+        f"<p style='text-align:center;margin:4px 0'>Dukku, Gombe State<br>{html.escape(timestamp)}</p>"
+        "<hr><table style='width:100%'>"
+        "<tr><th align='left'>QTY</th><th align='left'>ITEM</th>"
+        "<th style='text-align:right'>PRICE</th></tr>"
+        f"{rows}</table><hr>"
+        f"<p><b>TOTAL: N{grand_total:,}</b></p>"
+        "<p style='text-align:center'>Thank you for your patronage!</p></div>"
+    )
+
+def generate_receipt_image(items_df, grand_total, timestamp, mode="L"):
+    # Fonts
+    font_header, font_body, font_bold = get_fonts()
+
+    # Draw Receipt: row height measured from the body font rather than
+    # guessed, so the canvas is exactly as tall as the content;
+    # grayscale by default since receipts are black-on-white
+    line_h = font_body.getbbox("Ag")[3]
+    row_h = line_h + 8
+    width = 500
+    height = 210 + (len(items_df) * row_h) + 110
+    img = Image.new(mode, (width, height), "white")
+    img.paste(get_receipt_template(), (0, 0))
+    draw = ImageDraw.Draw(img)
+
+    # Date (the only dynamic header line)
+    draw.text((width//2, 120), timestamp, fill="black", font=font_body, anchor="mm")
+
+    # Items: one multiline call per column instead of three calls per row
+    y = 210
+    qty_block = "\n".join(str(qty) for qty in items_df['qty'])
+    item_block = "\n".join(item[:18] for item in items_df['item'])
+    price_block = "\n".join(f"N{total:,}" for total in items_df['line_total'])
+    draw.multiline_text((30, y), qty_block, font=font_body, fill="black", spacing=8)
+    draw.multiline_text((100, y), item_block, font=font_body, fill="black", spacing=8)
+    draw.multiline_text((380, y), price_block, font=font_body, fill="black", spacing=8)
+    y += row_h * len(items_df)
+
+    # Footer
+    draw.line([(20, y+10), (width-20, y+10)], fill="black", width=2)
+    y += 30
+    draw.text((30, y), "TOTAL:", font=font_bold, fill="black")
+    draw.text((380, y), f"N{grand_total:,}", font=font_bold, fill="black")
+    y += 60
+    draw.text((width//2, y), "Thank you for your patronage!", font=font_body, fill="black", anchor="mm")
+    return img
+
+# 5. MAIN APP INTERFACE
+st.title("🧾 Smart Invoice")
+
+tab1, tab2 = st.tabs(["🧾 New Invoice", "📊 Sales Dashboard"])
+
+with tab1:
+    st.write("Upload a handwritten list to generate a receipt.")
+
+    uploaded_file = st.file_uploader("Take a picture", type=["jpg", "jpeg", "png"])
+    # Read the upload buffer once; the same bytes feed the dedupe hash
+    # and the OCR cache key
+    img_bytes = uploaded_file.getvalue() if uploaded_file else None
+    current_hash = hashlib.sha1(img_bytes).hexdigest() if img_bytes else None
+
+    if uploaded_file and st.button("🚀 Process Invoice"):
+        if not api_key:
+            st.error("Please enter your Google API Key in the sidebar.")
+        elif st.session_state.get('last_file_hash') == current_hash:
+            # Same photo already processed this session; results below
+            pass
+        else:
+            with st.spinner('Thinking...'):
+                try:
+                    # Warm the receipt template cache while the Gemini
+                    # round-trip (1-5s, network-bound) is in flight
+                    with ThreadPoolExecutor(max_workers=1) as pool:
+                        template_future = pool.submit(get_receipt_template)
+                        raw_data = ocr_items(img_bytes, api_key)
+                        template_future.result()
+
+                    qtys = []
+                    items = []
+                    prices = []
+
+                    # --- PRICE MATCHING ENGINE ---
+                    # Normalize every AI name up front in one pass
+                    ai_names = [str(row.get('item', '')).strip().casefold() for row in raw_data]
+                    for row, ai_name in zip(raw_data, ai_names):
+                        qty = row.get('qty', 1)
+                        price = 0
+
+                        # 1. Try Exact Match (an exact hit skips fuzzy
+                        # entirely, even for genuine 0-price items)
+                        if ai_name in product_db:
+                            price = product_db[ai_name]
+
+                        # 2. Try Fuzzy Match (if exact fails)
+                        else:
+                            candidates = set()
+                            for token in _tokens(ai_name):
+                                candidates.update(token_index.get(token, ()))
+                            # No shared token (OCR typo) -> fall back to the full list
+                            match = process.extractOne(
+                                ai_name,
+                                candidates or db_names,
+                                scorer=fuzz.WRatio,
+                                score_cutoff=75,
+                            )
+                            if match:
+                                price = product_db[match[0]]
+                                # Rename item to the correct DB name
+                                row['item'] = match[0].title()
+
+                        qtys.append(qty)
+                        # Reuse the normalized name so a row without an
+                        # 'item' field can't abort the whole invoice
+                        items.append((row.get('item') or ai_name or 'Unknown').title())
+                        prices.append(price)
+
+                    # Line totals and grand total in one C-level pass
+                    line_totals = (np.array(qtys) * np.array(prices)).astype(np.int64)
+                    final_total = int(line_totals.sum())
+                    # Columns straight into a typed frame; no per-row
+                    # dicts for st.table to re-infer
+                    clean_df = pd.DataFrame(
+                        {"qty": qtys, "item": items, "line_total": line_totals}
+                    ).astype({"qty": "int32", "item": "string", "line_total": "int64"})
+
+                    # --- RECORD SALE ---
+                    items_summary = "; ".join(f"{q}x {i}" for q, i in zip(qtys, items))
+                    save_sale(items_summary, final_total)
+                    load_sales_data.clear()
+
+                    # --- RENDER RECEIPT ONCE, KEEP FOR RERUNS ---
+                    now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+                    receipt_img = generate_receipt_image(clean_df, final_total, now_str)
+                    # PNG: crisper text, fewer bytes, faster encode
+                    # than default JPEG for black-on-white receipts
+                    buf = io.BytesIO()
+                    receipt_img.save(buf, format="PNG", optimize=False, compress_level=1)
+
+                    st.session_state['last_file_hash'] = current_hash
+                    st.session_state['last_clean_df'] = clean_df
+                    st.session_state['last_total'] = final_total
+                    st.session_state['last_receipt_html'] = receipt_html(clean_df, final_total, now_str)
+                    st.session_state['last_receipt_png'] = buf.getvalue()
+
+                except ValueError as e:
+                    # Unparseable response (not cached, see ocr_items)
+                    st.error(str(e))
+                except Exception as e:
+                    if "429" in str(e):
+                        st.warning("🚦 Speed Limit Hit. Wait 30 seconds.")
+                    else:
+                        st.error(f"Error: {e}")
+
+    # --- DISPLAY RESULTS ---
+    # Rendered from session state so a download click (which reruns the
+    # whole script) doesn't trigger another Gemini call
+    if uploaded_file and st.session_state.get('last_file_hash') == current_hash:
+        st.success("Done!")
+        col1, col2 = st.columns(2)
+
+        with col1:
+            st.subheader("📝 List")
+            st.dataframe(st.session_state['last_clean_df'], use_container_width=True, hide_index=True)
+            st.metric("Total To Pay", f"₦{st.session_state['last_total']:,}")
+
+        with col2:
+            st.subheader("🖼️ Receipt")
+            # HTML preview on screen; the PNG bytes (encoded once at
+            # processing time) only go out through the download button
+            st.markdown(st.session_state['last_receipt_html'], unsafe_allow_html=True)
+            st.download_button(
+                "📥 Download Receipt",
+                data=st.session_state['last_receipt_png'],
+                file_name="receipt.png",
+                mime="image/png"
+            )
+
+with tab2:
+    st.subheader("📊 Sales History")
+    sales_df = load_sales_data()
+    if sales_df.empty:
+        st.info("No sales recorded yet.")
+    else:
+        st.metric("Total Sales", f"₦{sales_df['Total Amount'].sum():,.0f}")
+        # Newest first without a sort; cap the rows sent to the browser
+        st.dataframe(sales_df.iloc[::-1].head(200), use_container_width=True)
\ No newline at end of file